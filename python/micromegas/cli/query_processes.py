@@ -2,23 +2,18 @@ import argparse
 import datetime
 import importlib
 import os
-import re
 from tabulate import tabulate
 
+_UNIT_SECONDS = {"m": 60, "h": 60 * 60, "d": 24 * 60 * 60}
+
 
 def parse_time_delta(user_string):
-    parser = re.compile("(\\d+)([mhd])")
-    m = parser.match(user_string)
-    nbr = int(m.group(1))
-    unit = m.group(2)
-    if unit == "m":
-        return datetime.timedelta(minutes=nbr)
-    elif unit == "h":
-        return datetime.timedelta(hours=nbr)
-    elif unit == "d":
-        return datetime.timedelta(days=nbr)
-    else:
+    "parses [number][m|h|d]"
+    nbr = user_string[:-1]
+    unit_seconds = _UNIT_SECONDS.get(user_string[-1:])
+    if unit_seconds is None or not (nbr.isascii() and nbr.isdigit()):
         raise RuntimeError("invalid time delta: " + user_string)
+    return datetime.timedelta(seconds=int(nbr) * unit_seconds)
 
 
 def main():
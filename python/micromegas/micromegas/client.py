@@ -1,18 +1,53 @@
 from . import request
 import datetime
-import pandas
+import functools
 
 def format_datetime(value):
-    nonetype = type(None)
-    match type(value):
-        case datetime.datetime:
-            return value.isoformat()
-        case pandas.Timestamp:
-            return value.isoformat()
-        case nonetype:
-            return None
+    if value is None:
+        return None
+    # pandas.Timestamp is a subclass of datetime.datetime
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is None:
+            raise RuntimeError("datetime needs a valid time zone")
+        return value.isoformat()
+    if isinstance(value, str):
+        return _format_datetime_str(value)
     raise RuntimeError("value of unknown type in format_datetime")
-            
+
+
+# strings are compared exactly, unlike datetimes which are equal across time zones:
+# only the parsing of strings is cached
+@functools.lru_cache(maxsize=1024)
+def _format_datetime_str(value):
+    # fromisoformat only accepts the Z suffix since python 3.11
+    if value.endswith("Z"):
+        value = value[:-1] + "+00:00"
+    parsed = datetime.datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        raise RuntimeError("datetime needs a valid time zone")
+    return parsed.isoformat()
+
+
+def format_datetimes(values):
+    """
+    Formats a column of time zone aware timestamps as ISO 8601 strings, vectorized.
+    Unlike format_datetime, timestamps are converted to UTC and always written with
+    nine fractional digits, e.g. 2024-01-01T00:00:00.123456789+00:00.
+    Missing timestamps stay missing (NaN) and naive timestamps raise a RuntimeError.
+    """
+    import pandas
+
+    values = pandas.Series(values)
+    if not isinstance(values.dtype, pandas.DatetimeTZDtype):
+        raise RuntimeError("datetimes need a valid time zone")
+    utc = values.dt.tz_convert("UTC")
+    nanoseconds = utc.dt.microsecond * 1000 + utc.dt.nanosecond
+    return (
+        utc.dt.strftime("%Y-%m-%dT%H:%M:%S.")
+        + nanoseconds.astype("Int64").astype(str).str.zfill(9)
+        + "+00:00"
+    )
+
 
 class Client:
     def __init__(self, base_url, headers={}):
@@ -49,6 +84,9 @@ class Client:
         )
 
     def query_blocks(self, begin, end, limit, stream_id):
+        return self.query_blocks_arrow(begin, end, limit, stream_id).to_pandas()
+
+    def query_blocks_arrow(self, begin, end, limit, stream_id):
         args = {
             "begin": format_datetime(begin),
             "end": format_datetime(end),
@@ -56,14 +94,17 @@ class Client:
             "stream_id": stream_id,
         }
 
-        return request.request(
+        return request.arrow_request(
             self.analytics_base_url + "query_blocks",
             args,
             headers=self.headers,
         )
 
     def query_spans(self, begin, end, limit, stream_id):
-        return request.request(
+        return self.query_spans_arrow(begin, end, limit, stream_id).to_pandas()
+
+    def query_spans_arrow(self, begin, end, limit, stream_id):
+        return request.arrow_request(
             self.analytics_base_url + "query_spans",
             {
                 "begin": format_datetime(begin),
@@ -1,20 +1,85 @@
+import concurrent.futures
 import crc
+import datetime
+import functools
+import itertools
+import os
+import pyarrow
+import threading
 from tqdm import tqdm
 
 
 # hack to allow perfetto proto imports
 # you can then import the protos like this: from protos.perfetto.trace import trace_pb2
+# the generated modules register large descriptors when imported, they are only
+# loaded when a trace is written so that importing micromegas does not pay for it
 def load_perfetto_protos():
+    import os
     import sys
     import pathlib
 
     perfetto_folder = pathlib.Path(__file__).parent.absolute() / "thirdparty/perfetto"
-    sys.path.append(str(perfetto_folder))
+    if str(perfetto_folder) not in sys.path:
+        sys.path.append(str(perfetto_folder))
 
+    # protobuf>=4.21 defaults to the native upb backend, the pure-python one is
+    # only selected when forced through PROTOCOL_BUFFERS_PYTHON_IMPLEMENTATION
+    from google.protobuf.internal import api_implementation
 
+    if api_implementation.Type() == "python":
+        message = "protobuf is running its pure-python implementation, writing perfetto traces will be slow"
+        require_native = os.environ.get("MICROMEGAS_REQUIRE_NATIVE_PROTOBUF", "")
+        if require_native.lower() in ("1", "true", "yes"):
+            raise RuntimeError(message)
+        print("Warning: " + message)
+
+
+def preload_protos():
+    """
+    Imports the generated perfetto modules.
+    Call it before forking worker processes: they inherit the populated descriptor pool
+    instead of registering the descriptors again when writing their first trace.
+    """
+    load_perfetto_protos()
+    from protos.perfetto.trace import trace_packet_pb2, track_event  # noqa: F401
+
+
+_crc64_calculator = crc.Calculator(crc.Crc64.CRC64, optimized=True)
+# the calculator computes checksums in a single shared register
+_crc64_lock = threading.Lock()
+
+
+@functools.lru_cache(maxsize=None)
 def crc64_str(s):
-    calculator = crc.Calculator(crc.Crc64.CRC64)
-    return calculator.checksum(str.encode(s))
+    with _crc64_lock:
+        return _crc64_calculator.checksum(str.encode(s))
+
+
+def _timestamps_ns(column):
+    "nanoseconds since epoch as int64, without copying a single-chunk timestamp[ns] column"
+    if pyarrow.types.is_timestamp(column.type):
+        column = column.cast(pyarrow.timestamp("ns", tz=column.type.tz))
+    return column.cast(pyarrow.int64()).to_numpy()
+
+
+# a Trace is a sequence of TracePacket messages in field 1 (wire type 2)
+_TRACE_PACKET_TAG = b"\x0a"
+# TracePacket.timestamp is field 8 (wire type 0)
+_TIMESTAMP_TAG = b"\x40"
+
+
+def _varint_bytes(value):
+    "base 128 varint encoding of a non-negative integer"
+    encoded = bytearray()
+    while value > 0x7F:
+        encoded.append(0x80 | (value & 0x7F))
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+
+def _frame_packet(data):
+    return _TRACE_PACKET_TAG + _varint_bytes(len(data)) + data
 
 
 class Writer:
@@ -23,31 +88,60 @@ class Writer:
     Traces can be viewed using https://ui.perfetto.dev/
     """
 
-    def __init__(self, client, process_id, exe):
+    def __init__(self, client, process_id, exe, filename):
         load_perfetto_protos()
-        from protos.perfetto.trace import trace_pb2, trace_packet_pb2
+        from protos.perfetto.trace import trace_packet_pb2
 
         self.client = client
-        self.trace = trace_pb2.Trace()
-        self.packets = self.trace.packet
         self.process_uuid = crc64_str(process_id)
 
         packet = trace_packet_pb2.TracePacket()
         packet.track_descriptor.uuid = self.process_uuid
         packet.track_descriptor.process.pid = 1
         packet.track_descriptor.process.process_name = exe
-        self.packets.append(packet)
+        process_packet = _frame_packet(packet.SerializeToString())
+
+        # packets are written as they are built, the trace is never held in memory
+        # they go to a temporary file, only moved to filename by close()
+        self.filename = filename
+        self.temp_filename = str(filename) + ".tmp"
+        self.file = open(self.temp_filename, "wb", buffering=1024 * 1024)
+        self.write(process_packet)
+
+    def write(self, data):
+        self.file.write(data)
 
     def append_thread(self, stream_id, thread_name, thread_id):
-        from protos.perfetto.trace import trace_pb2, trace_packet_pb2, track_event
+        self.write(self.format_thread(stream_id, thread_name, thread_id))
 
-        df_blocks = self.client.query_blocks(
-            begin=None, end=None, limit=100_000, stream_id=stream_id
+    def format_thread(self, stream_id, thread_name, thread_id, begin=None, end=None):
+        """
+        Returns the serialized packets of a thread without writing them to the trace.
+        Can be called concurrently for different threads of the trace.
+        Without a time range, the range of the stream's blocks is fetched first.
+        """
+        import pandas
+        from protos.perfetto.trace import trace_packet_pb2, track_event
+
+        buffer = bytearray()
+        if begin is None or end is None:
+            df_blocks = self.client.query_blocks(
+                begin=None, end=None, limit=100_000, stream_id=stream_id
+            )
+            if df_blocks.empty:
+                return buffer
+            begin = df_blocks["begin_time"].min()
+            end = df_blocks["end_time"].max()
+
+        max_rows = 1024 * 1024
+        spans = self.client.query_spans_arrow(
+            begin, end, limit=max_rows, stream_id=stream_id
         )
-        if df_blocks.empty:
-            return
-        begin = df_blocks["begin_time"].min()
-        end = df_blocks["end_time"].max()
+        nb_rows = spans.num_rows
+        if nb_rows == 0:
+            return buffer
+        if nb_rows == max_rows:
+            print("Warning: partial data returned, needs multiple requests")
 
         packet = trace_packet_pb2.TracePacket()
         thread_uuid = crc64_str(stream_id)
@@ -56,49 +150,107 @@ class Writer:
         packet.track_descriptor.thread.pid = 1
         packet.track_descriptor.thread.tid = thread_id
         packet.track_descriptor.thread.thread_name = thread_name
-        self.packets.append(packet)
+        buffer += _frame_packet(packet.SerializeToString())
         trusted_packet_sequence_id = 1
 
-        max_rows = 1024 * 1024
-        df_spans = self.client.query_spans(
-            begin, end, limit=max_rows, stream_id=stream_id
+        begin_ns = _timestamps_ns(spans["begin"])
+        end_ns = _timestamps_ns(spans["end"])
+        TrackEvent = track_event.track_event_pb2.TrackEvent
+        TYPE_SLICE_BEGIN = TrackEvent.Type.TYPE_SLICE_BEGIN
+        TYPE_SLICE_END = TrackEvent.Type.TYPE_SLICE_END
+        # (target, filename, line, name) repeat heavily across spans: build each
+        # TrackEvent once and reuse it for all the spans sharing it
+        # only these columns go through pandas: name, target and filename are
+        # dictionary-encoded and become categoricals, line is a plain UInt32
+        template_columns = ["target", "filename", "line", "name"]
+        template_ids, unique_events = pandas.factorize(
+            pandas.MultiIndex.from_frame(spans.select(template_columns).to_pandas())
         )
-        nb_rows = df_spans.shape[0]
-        if nb_rows == max_rows:
-            print("Warning: partial data returned, needs multiple requests")
+        # strings are interned once per thread, in a packet clearing the incremental
+        # state of the sequence: the packets of a thread are contiguous in the trace,
+        # so all the threads can share the same sequence id
+        TracePacket = trace_packet_pb2.TracePacket
+        unique_events = unique_events.to_frame(index=False, name=template_columns)
+        category_ids, categories = pandas.factorize(unique_events["target"])
+        name_ids, names = pandas.factorize(unique_events["name"])
+        location_ids, locations = pandas.factorize(
+            pandas.MultiIndex.from_frame(unique_events[["filename", "line"]])
+        )
+        packet = TracePacket()
+        packet.timestamp = int(begin_ns.min())
+        packet.trusted_packet_sequence_id = trusted_packet_sequence_id
+        packet.sequence_flags = TracePacket.SEQ_INCREMENTAL_STATE_CLEARED
+        interned_data = packet.interned_data
+        # iid 0 is reserved
+        for iid, category in enumerate(categories, start=1):
+            interned_data.event_categories.add(iid=iid, name=category)
+        for iid, name in enumerate(names, start=1):
+            interned_data.event_names.add(iid=iid, name=name)
+        for iid, (filename, line) in enumerate(locations, start=1):
+            interned_data.source_locations.add(
+                iid=iid, file_name=filename, line_number=line
+            )
+        buffer += _frame_packet(packet.SerializeToString())
 
-        begin_ns = df_spans["begin"].astype("int64")
-        end_ns = df_spans["end"].astype("int64")
-        for index, span in df_spans.iterrows():
-            packet = trace_packet_pb2.TracePacket()
-            packet.timestamp = begin_ns[index]
-            packet.track_event.type = (
-                track_event.track_event_pb2.TrackEvent.Type.TYPE_SLICE_BEGIN
+        templates = []
+        for category_id, name_id, location_id in zip(
+            category_ids.tolist(), name_ids.tolist(), location_ids.tolist()
+        ):
+            templates.append(
+                TrackEvent(
+                    track_uuid=thread_uuid,
+                    category_iids=[category_id + 1],
+                    name_iid=name_id + 1,
+                    source_location_iid=location_id + 1,
+                )
             )
-            packet.track_event.track_uuid = thread_uuid
-            packet.track_event.name = span["name"]
-            packet.track_event.categories.append(span["target"])
-            packet.track_event.source_location.file_name = span["filename"]
-            packet.track_event.source_location.line_number = span["line"]
-            packet.trusted_packet_sequence_id = trusted_packet_sequence_id
-            self.packets.append(packet)
-
-            packet = trace_packet_pb2.TracePacket()
-            packet.timestamp = end_ns[index]
-            packet.track_event.type = (
-                track_event.track_event_pb2.TrackEvent.Type.TYPE_SLICE_END
+
+        # span packets only differ by their timestamp and template: serialize the
+        # rest of the begin and end packets once per template
+        begin_packet = TracePacket()
+        begin_packet.trusted_packet_sequence_id = trusted_packet_sequence_id
+        begin_packet.sequence_flags = TracePacket.SEQ_NEEDS_INCREMENTAL_STATE
+        end_packet = TracePacket()
+        end_packet.trusted_packet_sequence_id = trusted_packet_sequence_id
+        end_packet.sequence_flags = TracePacket.SEQ_NEEDS_INCREMENTAL_STATE
+        begin_packets = []
+        end_packets = []
+        for template in templates:
+            begin_packet.track_event.CopyFrom(template)
+            begin_packet.track_event.type = TYPE_SLICE_BEGIN
+            begin_packets.append(begin_packet.SerializeToString())
+            end_packet.track_event.CopyFrom(template)
+            end_packet.track_event.type = TYPE_SLICE_END
+            end_packets.append(end_packet.SerializeToString())
+
+        # timestamp is the field with the lowest number in the packets we write,
+        # prepending it to a packet serialized without it gives the same bytes
+        # as setting it before serialization
+        # module globals are bound to locals, this loop runs for every span
+        frame_packet = _frame_packet
+        varint_bytes = _varint_bytes
+        timestamp_tag = _TIMESTAMP_TAG
+        for template_id, begin_timestamp, end_timestamp in zip(
+            template_ids.tolist(), begin_ns.tolist(), end_ns.tolist()
+        ):
+            buffer += frame_packet(
+                timestamp_tag
+                + varint_bytes(begin_timestamp)
+                + begin_packets[template_id]
+            )
+            buffer += frame_packet(
+                timestamp_tag + varint_bytes(end_timestamp) + end_packets[template_id]
             )
-            packet.track_event.track_uuid = thread_uuid
-            packet.track_event.name = span["name"]
-            packet.track_event.categories.append(span["target"])
-            packet.track_event.source_location.file_name = span["filename"]
-            packet.track_event.source_location.line_number = span["line"]
-            packet.trusted_packet_sequence_id = trusted_packet_sequence_id
-            self.packets.append(packet)
+        return buffer
 
-    def write_file(self, filename):
-        with open(filename, "wb") as f:
-            f.write(self.trace.SerializeToString())
+    def close(self):
+        self.file.close()
+        os.replace(self.temp_filename, self.filename)
+
+    def discard(self):
+        "closes the trace without creating filename"
+        self.file.close()
+        os.remove(self.temp_filename)
 
 
 def get_process_cpu_streams(client, process_id):
@@ -128,8 +280,28 @@ def write_process_trace(client, process_id, trace_filepath):
     assert process_df.shape[0] == 1
     process = process_df.iloc[0]
     streams = get_process_cpu_streams(client, process_id)
-    writer = Writer(client, process_id, process["exe"])
-    for index, stream in tqdm(list(streams.iterrows())):
-        stream_id = stream["thread_id"]
-        writer.append_thread(stream["stream_id"], stream["thread_name"], stream_id)
-    writer.write_file(trace_filepath)
+    # the server clamps the range to the blocks of each stream: querying the spans
+    # over the lifetime of the process saves a blocks request per thread
+    # the end is only a bound, with a margin for processes whose clock is ahead
+    # of ours or that are still running
+    begin = process["start_time"]
+    end = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(days=1)
+    writer = Writer(client, process_id, process["exe"], trace_filepath)
+    try:
+        # threads are fetched and formatted concurrently, then written in order
+        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+            buffers = executor.map(
+                writer.format_thread,
+                streams["stream_id"],
+                streams["thread_name"],
+                streams["thread_id"],
+                itertools.repeat(begin),
+                itertools.repeat(end),
+            )
+            for buffer in tqdm(buffers, total=streams.shape[0]):
+                writer.write(buffer)
+    except BaseException:
+        # a partial trace is never left at trace_filepath
+        writer.discard()
+        raise
+    writer.close()
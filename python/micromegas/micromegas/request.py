@@ -1,14 +1,40 @@
 import cbor2
-import io
+import functools
+import pyarrow
 import pyarrow.parquet as pq
 import requests
+from requests.adapters import HTTPAdapter
 
+# shared across calls (and threads) so that connections are kept alive and reused
+_session = requests.Session()
+_session.mount("http://", HTTPAdapter(pool_connections=16, pool_maxsize=64))
+_session.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=64))
 
-def request(url, args, headers={}):
-    response = requests.post(
+
+# only values of these exact types are cached: others can compare equal and still
+# encode differently, e.g. True == 1, (True,) == (1,) or -0.0 == 0.0
+_CACHED_ARG_TYPES = (str, int, type(None))
+
+
+@functools.lru_cache(maxsize=256)
+def _encode_args(args_items):
+    return cbor2.dumps(dict(args_items))
+
+
+def _encode_request_args(args):
+    # the same filters are sent over and over (e.g. one query per stream and table),
+    # their encoding is cached when all the values are simple
+    if all(type(k) is str and type(v) in _CACHED_ARG_TYPES for k, v in args.items()):
+        return _encode_args(tuple(args.items()))
+    return cbor2.dumps(args)
+
+
+def arrow_request(url, args, headers={}):
+    data = _encode_request_args(args)
+    response = _session.post(
         url,
         headers=headers,
-        data=cbor2.dumps(args),
+        data=data,
     )
     if response.status_code != 200:
         raise Exception(
@@ -16,5 +42,9 @@ def request(url, args, headers={}):
                 response.status_code, response.text, url
             )
         )
-    table = pq.read_table(io.BytesIO(response.content))
-    return table.to_pandas()
+    # wrapping the body in an arrow buffer lets the parquet reader access it without copies
+    return pq.read_table(pyarrow.py_buffer(response.content))
+
+
+def request(url, args, headers={}):
+    return arrow_request(url, args, headers=headers).to_pandas()
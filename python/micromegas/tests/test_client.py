@@ -0,0 +1,28 @@
+import datetime
+import pandas as pd
+import pytest
+from micromegas.client import format_datetimes
+
+
+def test_format_datetimes():
+    values = pd.Series(
+        [
+            pd.Timestamp("2024-01-01T02:00:00.123456789+02:00"),
+            pd.NaT,
+            pd.Timestamp("2024-03-01T00:00:00+01:00"),
+        ]
+    ).astype("datetime64[ns, Europe/Paris]")
+    formatted = format_datetimes(values)
+    assert formatted[0] == "2024-01-01T00:00:00.123456789+00:00"
+    assert pd.isna(formatted[1])
+    assert formatted[2] == "2024-02-29T23:00:00.000000000+00:00"
+
+
+def test_format_datetimes_from_datetimes():
+    values = [datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)]
+    assert format_datetimes(values).tolist() == ["2024-01-01T00:00:00.000000000+00:00"]
+
+
+def test_format_datetimes_naive():
+    with pytest.raises(RuntimeError):
+        format_datetimes(pd.Series(pd.to_datetime(["2024-01-01"])))
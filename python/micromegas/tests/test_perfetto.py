@@ -0,0 +1,200 @@
+import pandas as pd
+import pyarrow
+import pytest
+from micromegas import perfetto
+
+perfetto.load_perfetto_protos()
+from protos.perfetto.trace import trace_packet_pb2, trace_pb2
+from protos.perfetto.trace.track_event import track_event_pb2
+
+
+def make_spans(spans):
+    "spans are (begin_ns, end_ns, name, target, filename, line) tuples"
+    begin, end, name, target, filename, line = zip(*spans) if spans else [()] * 6
+    timestamp = pyarrow.timestamp("ns", tz="+00:00")
+    string = pyarrow.string()
+    return pyarrow.table(
+        {
+            "begin": pyarrow.array(begin, timestamp),
+            "end": pyarrow.array(end, timestamp),
+            "name": pyarrow.array(name, string).dictionary_encode(),
+            "target": pyarrow.array(target, string).dictionary_encode(),
+            "filename": pyarrow.array(filename, string).dictionary_encode(),
+            "line": pyarrow.array(line, pyarrow.uint32()),
+        }
+    )
+
+
+class StubClient:
+    "serves a process whose cpu streams are given as {stream_id: (thread_name, thread_id, spans)}"
+
+    def __init__(self, streams):
+        self.streams = streams
+
+    def find_process(self, process_id):
+        return pd.DataFrame(
+            {
+                "exe": ["test.exe"],
+                "start_time": [pd.Timestamp(0, tz="UTC")],
+            }
+        )
+
+    def query_streams(self, begin, end, limit, process_id=None, tag_filter=None):
+        return pd.DataFrame(
+            {
+                "stream_id": list(self.streams.keys()),
+                "properties": [
+                    [
+                        {"key": "thread-name", "value": thread_name},
+                        {"key": "thread-id", "value": str(thread_id)},
+                    ]
+                    for thread_name, thread_id, spans in self.streams.values()
+                ],
+            }
+        )
+
+    def query_spans_arrow(self, begin, end, limit, stream_id):
+        return self.streams[stream_id][2]
+
+
+def read_trace(path):
+    trace = trace_pb2.Trace()
+    with open(path, "rb") as f:
+        trace.ParseFromString(f.read())
+    return trace
+
+
+def test_write_process_trace(tmp_path):
+    spans = make_spans(
+        [
+            (1000, 3000, "outer", "app", "main.rs", 10),
+            (1500, 2000, "inner", "app", "main.rs", 20),
+        ]
+    )
+    client = StubClient({"stream-1": ("main", 1, spans)})
+    path = tmp_path / "trace.pftrace"
+    perfetto.write_process_trace(client, "process-1", str(path))
+
+    trace = read_trace(path)
+    thread_uuids = [
+        packet.track_descriptor.uuid
+        for packet in trace.packet
+        if packet.track_descriptor.HasField("thread")
+    ]
+    assert thread_uuids == [perfetto.crc64_str("stream-1")]
+    events = [packet for packet in trace.packet if packet.HasField("track_event")]
+    TrackEvent = track_event_pb2.TrackEvent
+    assert [(packet.timestamp, packet.track_event.type) for packet in events] == [
+        (1000, TrackEvent.TYPE_SLICE_BEGIN),
+        (3000, TrackEvent.TYPE_SLICE_END),
+        (1500, TrackEvent.TYPE_SLICE_BEGIN),
+        (2000, TrackEvent.TYPE_SLICE_END),
+    ]
+    for packet in events:
+        assert packet.track_event.track_uuid == thread_uuids[0]
+
+
+def resolve_events(trace):
+    """
+    Returns the track events of the trace as
+    (thread_name, timestamp, type, name, category, filename, line) tuples,
+    resolving the interned strings like the perfetto trace processor.
+    """
+    thread_names = {}
+    names, categories, locations = {}, {}, {}
+    events = []
+    for packet in trace.packet:
+        if packet.track_descriptor.HasField("thread"):
+            descriptor = packet.track_descriptor
+            thread_names[descriptor.uuid] = descriptor.thread.thread_name
+        if (
+            packet.sequence_flags
+            & trace_packet_pb2.TracePacket.SEQ_INCREMENTAL_STATE_CLEARED
+        ):
+            names, categories, locations = {}, {}, {}
+        for entry in packet.interned_data.event_names:
+            names[entry.iid] = entry.name
+        for entry in packet.interned_data.event_categories:
+            categories[entry.iid] = entry.name
+        for entry in packet.interned_data.source_locations:
+            locations[entry.iid] = (entry.file_name, entry.line_number)
+        if packet.HasField("track_event"):
+            event = packet.track_event
+            assert len(event.category_iids) == 1
+            events.append(
+                (
+                    thread_names[event.track_uuid],
+                    packet.timestamp,
+                    event.type,
+                    names[event.name_iid],
+                    categories[event.category_iids[0]],
+                )
+                + locations[event.source_location_iid]
+            )
+    return events
+
+
+def test_write_process_trace_threads(tmp_path):
+    # threads share the packet sequence: each one resets the interned strings
+    client = StubClient(
+        {
+            "stream-1": (
+                "main",
+                1,
+                make_spans(
+                    [
+                        (1000, 2000, "update", "game", "main.rs", 10),
+                        (3000, 4000, "render", "gfx", "render.rs", 20),
+                    ]
+                ),
+            ),
+            "stream-2": ("idle", 2, make_spans([])),
+            "stream-3": (
+                "worker",
+                3,
+                make_spans(
+                    [
+                        (1500, 2500, "load", "io", "io.rs", 30),
+                        (2600, 2700, "update", "game", "io.rs", 40),
+                    ]
+                ),
+            ),
+        }
+    )
+    path = tmp_path / "trace.pftrace"
+    perfetto.write_process_trace(client, "process-1", str(path))
+
+    trace = read_trace(path)
+    # threads without spans get no track
+    thread_names = [
+        packet.track_descriptor.thread.thread_name
+        for packet in trace.packet
+        if packet.track_descriptor.HasField("thread")
+    ]
+    assert thread_names == ["main", "worker"]
+    BEGIN = track_event_pb2.TrackEvent.TYPE_SLICE_BEGIN
+    END = track_event_pb2.TrackEvent.TYPE_SLICE_END
+    assert resolve_events(trace) == [
+        ("main", 1000, BEGIN, "update", "game", "main.rs", 10),
+        ("main", 2000, END, "update", "game", "main.rs", 10),
+        ("main", 3000, BEGIN, "render", "gfx", "render.rs", 20),
+        ("main", 4000, END, "render", "gfx", "render.rs", 20),
+        ("worker", 1500, BEGIN, "load", "io", "io.rs", 30),
+        ("worker", 2500, END, "load", "io", "io.rs", 30),
+        ("worker", 2600, BEGIN, "update", "game", "io.rs", 40),
+        ("worker", 2700, END, "update", "game", "io.rs", 40),
+    ]
+
+
+def test_write_process_trace_failure(tmp_path):
+    class FailingClient(StubClient):
+        def query_spans_arrow(self, begin, end, limit, stream_id):
+            raise RuntimeError("query failed")
+
+    spans = make_spans([(1000, 2000, "span", "app", "main.rs", 10)])
+    client = FailingClient({"stream-1": ("main", 1, spans)})
+    with pytest.raises(RuntimeError):
+        perfetto.write_process_trace(
+            client, "process-1", str(tmp_path / "trace.pftrace")
+        )
+    assert list(tmp_path.iterdir()) == []
@@ -1,9 +1,10 @@
 #!/usr/bin/python3
 import micromegas
 
+import concurrent.futures
 import datetime
 import pandas as pd
-import tabulate
+import pyarrow.compute as pc
 
 
 BASE_URL = "http://localhost:8082/"
@@ -20,11 +21,14 @@ def test_list_streams():
     print(df)
 
 def test_process_streams():
+    def query_process_streams(process_id):
+        return client.query_streams(begin, end, limit, process_id=process_id)
+
     process_df = client.query_processes(begin, end, limit)
-    process_df = process_df[["process_id", "exe", "start_time", "properties"]]
-    for index, row in process_df.iterrows():
-        streams = client.query_streams(begin, end, limit, process_id=row["process_id"])
-        print(streams)
+    # the streams requests are independent, they are sent concurrently
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+        for streams in executor.map(query_process_streams, process_df["process_id"]):
+            print(streams)
         
 def test_find_cpu_stream():
     df = client.query_streams(begin, end, limit, tag_filter="cpu")
@@ -34,13 +38,14 @@ def get_tagged_streams_with_data(tag_filter):
     streams_df = client.query_streams(begin, end, limit, tag_filter=tag_filter)
     streams_stats = {}
     for index, row in streams_df.iterrows():
-        blocks_df = client.query_blocks(begin, end, limit, row["stream_id"])
-        if len(blocks_df) == 0:
+        # only two sums are needed, they are computed on the arrow table
+        blocks = client.query_blocks_arrow(begin, end, limit, row["stream_id"])
+        if blocks.num_rows == 0:
             stats = {"sum_payload": 0, "nb_events": 0}
         else:
             stats = {
-                "sum_payload": blocks_df["payload_size"].sum(),
-                "nb_events": blocks_df["nb_objects"].sum(),
+                "sum_payload": pc.sum(blocks["payload_size"]).as_py(),
+                "nb_events": pc.sum(blocks["nb_objects"]).as_py(),
             }
         streams_stats[row["stream_id"]] = stats
     streams_stats = pd.DataFrame(streams_stats).transpose()
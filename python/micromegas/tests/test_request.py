@@ -0,0 +1,18 @@
+import cbor2
+from micromegas.request import _encode_request_args
+
+
+def test_encode_request_args():
+    # values that compare equal but encode differently must not share a cache entry
+    for args in [
+        {"x": 1},
+        {"x": True},
+        {"x": 1.0},
+        {"x": (1,)},
+        {"x": (True,)},
+        {"x": 0.0},
+        {"x": -0.0},
+        {"x": None, "limit": 1024, "stream_id": "abc"},
+        {"x": [1, 2]},
+    ]:
+        assert _encode_request_args(args) == cbor2.dumps(args)